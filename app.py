@@ -1,15 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import click
+import contextlib
+import fcntl
+import functools
+import gzip
+import hashlib
+import http.client
 import json
+import os
 import re
+import shutil
+import sqlite3
 import sys
-import urllib.request
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.error
+import urllib.parse
 import xml.etree.ElementTree as ET
-from flask import Flask, render_template, request
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from flask import Flask, abort, g, has_request_context, render_template, request, stream_with_context
+from html import unescape as unescape_html
+from markupsafe import Markup
 from xml.sax.saxutils import unescape
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
-app.config.from_pyfile('config/local.py')
+app.config.from_pyfile(os.environ.get('LUCY_SETTINGS', 'config/local.py'))
 
 def get_xml_contents(e):
     """Get the contents of a node as a string of text and XML 
@@ -21,9 +46,805 @@ def get_xml_contents(e):
     closing_indices = [i for i, c in enumerate(e_str) if c == '>']
     return e_str[closing_indices[0]+1:opening_indices[-1]]
 
-class Lucy:
+class Metrics:
+    """Counters and histograms, served in the Prometheus text format at
+       /metrics.
+
+       Each process collects them in memory, and adds what it has
+       collected to the totals in the shared cache (see SharedCache)
+       every METRICS_FLUSH_INTERVAL seconds, after a request, and before
+       serving /metrics. So /metrics reports every process's metrics,
+       whichever process serves it, and counters don't go down when a
+       process restarts.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = {}
+        self.flushed = time.time()
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def key(self, name, labels):
+        # label values are kept as strings, so keys always sort.
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key,
+                {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0}
+            )
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def flush(self):
+        """Add what has been collected since the last flush to the
+           totals in the shared cache.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            self.flushed = time.time()
+        rows = []
+        for (name, pairs), value in counters.items():
+            rows.append(('counter', name, json.dumps(pairs), 'value', value))
+        for (name, pairs), histogram in histograms.items():
+            labels = json.dumps(pairs)
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                rows.append(('histogram', name, labels, str(bound), count))
+            rows.append(('histogram', name, labels, 'count', histogram['count']))
+            rows.append(('histogram', name, labels, 'sum', histogram['sum']))
+        if rows:
+            shared_cache.add_metrics(rows)
+
+    def flush_soon(self):
+        """Flush, if it has been METRICS_FLUSH_INTERVAL seconds since
+           the last time.
+        """
+        if time.time() - self.flushed >= app.config.get('METRICS_FLUSH_INTERVAL', 10):
+            self.flush()
+
+    def render(self):
+        def labels(pairs):
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+        self.flush()
+        bounds = [str(bound) for bound in self.BUCKETS]
+        counters = {}
+        histograms = {}
+        for kind, name, pairs, field, value in shared_cache.get_metrics():
+            key = (name, tuple(tuple(pair) for pair in json.loads(pairs)))
+            if kind == 'counter':
+                counters[key] = int(value) if value == int(value) else value
+                continue
+            histogram = histograms.setdefault(
+                key,
+                {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0}
+            )
+            if field == 'count':
+                histogram['count'] = int(value)
+            elif field == 'sum':
+                histogram['sum'] = value
+            elif field in bounds:
+                histogram['buckets'][bounds.index(field)] = int(value)
+
+        lines = []
+        names = set()
+        for (name, pairs), value in sorted(counters.items()):
+            if name not in names:
+                lines.append('# TYPE {} counter'.format(name))
+                names.add(name)
+            lines.append('{}{} {}'.format(name, labels(pairs), value))
+        for (name, pairs), histogram in sorted(histograms.items()):
+            if name not in names:
+                lines.append('# TYPE {} histogram'.format(name))
+                names.add(name)
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                lines.append('{}_bucket{} {}'.format(
+                    name, labels(pairs + (('le', bound),)), count
+                ))
+            lines.append('{}_bucket{} {}'.format(
+                name, labels(pairs + (('le', '+Inf'),)), histogram['count']
+            ))
+            lines.append('{}_sum{} {}'.format(name, labels(pairs), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, labels(pairs), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# per thread, the time spent in phases nested inside each running phase.
+phases = threading.local()
+
+@contextlib.contextmanager
+def timed(phase):
+    """Time a phase of handling a request, for the lucy_phase_seconds
+       histogram and the response's Server-Timing header. Time spent in
+       a phase timed inside this one (e.g. grammar inside extract) is
+       only counted toward the inner phase.
+    """
+    if not hasattr(phases, 'nested'):
+        phases.nested = []
+    stack = phases.nested
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - start
+        elapsed = total - stack.pop()
+        if stack:
+            stack[-1] += total
+        metrics.observe('lucy_phase_seconds', elapsed, phase=phase)
+        if has_request_context():
+            timings = g.setdefault('timings', {})
+            timings[phase] = timings.get(phase, 0) + elapsed
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    elapsed = time.perf_counter() - g.start
+    # requests that match no route (e.g. for /favicon.ico) have no
+    # endpoint.
+    metrics.observe('lucy_request_seconds', elapsed, endpoint=request.endpoint or 'none')
+    metrics.flush_soon()
+    timings = g.get('timings', {})
+    timings['total'] = elapsed
+    response.headers['Server-Timing'] = ', '.join(
+        '{};dur={:.1f}'.format(phase, duration * 1000)
+        for phase, duration in timings.items()
+    )
+    return response
+
+@app.route("/metrics")
+def metrics_view():
+    return app.response_class(
+        metrics.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+def ochre_url(uuid):
+    """Get the OCHRE API URL for a UUID."""
+    return '{}/ochre?uuid={}'.format(app.config['OCHRE_SERVER'], uuid)
+
+class SingleFlight:
+    """Coalesce concurrent calls: while a call for a key is running,
+       other calls for the same key wait for it and share its result
+       (or exception) instead of running again.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+in_flight = SingleFlight()
+
+class CircuitOpenError(urllib.error.URLError):
+    """Raised instead of contacting an upstream server that has been
+       failing.
+    """
+
+
+# what sending a request on a kept-alive connection raises if the server
+# has closed it in the meantime.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+class HTTPClient:
+    """An HTTP client for upstream servers, shared by every thread.
+
+       Connections are kept alive and reused between requests. Requests
+       that fail to connect, time out, or get a 502, 503 or 504 are
+       retried OCHRE_RETRIES times, with exponential backoff. After
+       OCHRE_BREAKER_THRESHOLD failures in a row a server isn't
+       contacted again for OCHRE_BREAKER_RESET seconds: requests fail
+       right away with CircuitOpenError, so that callers fall back to
+       their cached copies instead of tying up worker threads. Then a
+       single request is let through to see if the server has
+       recovered.
+
+       Errors are raised as urllib.error.URLError and HTTPError, the
+       same as urllib.request.urlopen().
+    """
+    def __init__(self):
+        self.failures = {}
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = {}
+
+    @contextlib.contextmanager
+    def get(self, url, headers=None, timeout=None):
+        """GET a URL, following redirects. Use as a context manager:
+           the connection is returned to the pool on exit if the
+           response was read to the end.
+        """
+        if timeout is None:
+            timeout = app.config.get('OCHRE_TIMEOUT', 10)
+        for _ in range(5):
+            conn, response = self.send(url, headers or {}, timeout)
+            location = response.getheader('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            response.read()
+            self.release(conn, response)
+            url = urllib.parse.urljoin(url, location)
+        try:
+            if response.status >= 300:
+                response.read()
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            yield response
+        finally:
+            self.release(conn, response)
+
+    def send(self, url, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        default_port = 443 if parts.scheme == 'https' else 80
+        host = (parts.scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        self.check_circuit(host)
+        retries = app.config.get('OCHRE_RETRIES', 2)
+        attempt = 0
+        while True:
+            conn, reused = self.connection(host, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if reused and isinstance(e, STALE_CONNECTION_ERRORS):
+                    # the server closed a kept-alive connection, which
+                    # doesn't count as a failure. Anything else, like a
+                    # timeout, does.
+                    continue
+                error = e
+            else:
+                if response.status not in (502, 503, 504):
+                    self.record(host, True)
+                    return conn, response
+                if attempt == retries:
+                    self.record(host, False)
+                    return conn, response
+                response.read()
+                self.release(conn, response)
+                error = None
+            if attempt == retries:
+                self.record(host, False)
+                raise urllib.error.URLError(error)
+            time.sleep(app.config.get('OCHRE_BACKOFF', 0.5) * 2 ** attempt)
+            attempt += 1
+
+    def connection(self, host, timeout):
+        """Get an idle connection to a host, or a new one. Returns the
+           connection and whether it is being reused.
+        """
+        with self.lock:
+            idle = self.idle.get(host)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, hostname, port = host
+        if scheme == 'https':
+            return http.client.HTTPSConnection(hostname, port, timeout=timeout), False
+        return http.client.HTTPConnection(hostname, port, timeout=timeout), False
+
+    def release(self, conn, response):
+        """Put a connection back in the pool, if it can be reused."""
+        if response.isclosed() and not response.will_close:
+            host = (
+                'https' if isinstance(conn, http.client.HTTPSConnection) else 'http',
+                conn.host,
+                conn.port
+            )
+            with self.lock:
+                idle = self.idle.setdefault(host, [])
+                if len(idle) < app.config.get('OCHRE_POOL_SIZE', 10):
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def check_circuit(self, host):
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            if time.time() - opened < app.config.get('OCHRE_BREAKER_RESET', 30):
+                raise CircuitOpenError('{} is failing'.format(host[1]))
+            # let this request through to test the server, but keep
+            # failing fast for everyone else until it comes back.
+            self.opened[host] = time.time()
+
+    def record(self, host, success):
+        with self.lock:
+            if success:
+                self.failures.pop(host, None)
+                self.opened.pop(host, None)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= app.config.get('OCHRE_BREAKER_THRESHOLD', 5):
+                self.opened[host] = time.time()
+
+
+http_client = HTTPClient()
+
+CHUNK_SIZE = 64 * 1024
+
+def fetch_xml(url, ttl=None):
+    """Get the raw XML at a URL, through an on-disk cache. See
+       fetch_xml_file().
+    """
+    xml_path, meta = fetch_xml_file(url, ttl)
+    with open(xml_path, 'rb') as f:
+        return f.read()
+
+def fetch_xml_file(url, ttl=None, feed=None):
+    """Get the path of a cached copy of the XML at a URL, and its
+       metadata, including the SHA-1 of its contents.
+
+       Cached documents are served without contacting the upstream
+       server for ttl seconds (by default, OCHRE_CACHE_TTL). After that
+       they are revalidated with If-None-Match / If-Modified-Since, so
+       an unchanged document costs a 304 instead of a full download.
+       If the upstream server can't be reached, a stale copy is better
+       than an error page.
+
+       Downloads are streamed to disk. If feed is given, it is called
+       with each chunk of a download as it arrives, so that the caller
+       can start parsing before the download finishes.
+
+       Only one thread at a time contacts the upstream server for a
+       URL; any others that need it wait for that thread's result.
+       (Their feed isn't called.) The cache directory is shared by
+       every process, and a lock file keeps other processes from
+       fetching the same URL at the same time.
+    """
+    cache_dir = get_cache_dir()
+    if ttl is None:
+        ttl = app.config.get('OCHRE_CACHE_TTL', 24 * 60 * 60)
+
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    xml_path = os.path.join(cache_dir, key + '.xml')
+    meta_path = os.path.join(cache_dir, key + '.json')
+
+    def read_meta():
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if 'sha1' not in meta:
+                meta['sha1'] = file_sha1(xml_path)
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    meta = read_meta()
+    if meta is not None and time.time() - meta['fetched'] < ttl:
+        metrics.inc('lucy_cache_requests_total', cache='xml', result='hit')
+        return xml_path, meta
+
+    def revalidate():
+        lock_path = os.path.join(cache_dir, key + '.lock')
+        try:
+            with file_lock(lock_path):
+                return fetch(read_meta())
+        except Exception:
+            # don't leave a lock file behind for a URL that has never
+            # been fetched.
+            if not os.path.exists(meta_path):
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+            raise
+
+    def fetch(meta):
+        # another thread or process may have just finished fetching this.
+        if meta is not None and time.time() - meta['fetched'] < ttl:
+            metrics.inc('lucy_cache_requests_total', cache='xml', result='hit')
+            return xml_path, meta
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            with http_client.get(url, headers) as response:
+                tmp_path, sha1 = download(response, cache_dir, feed)
+                meta = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'sha1': sha1,
+                    'url': url
+                }
+            os.replace(tmp_path, xml_path)
+            metrics.inc('lucy_cache_requests_total', cache='xml', result='miss')
+        except urllib.error.HTTPError as e:
+            if meta is None:
+                raise
+            if e.code != 304:
+                metrics.inc('lucy_cache_requests_total', cache='xml', result='stale')
+                return xml_path, meta
+            metrics.inc('lucy_cache_requests_total', cache='xml', result='revalidated')
+        except OSError:
+            # URLError, or a socket timeout while reading the response.
+            if meta is None:
+                raise
+            metrics.inc('lucy_cache_requests_total', cache='xml', result='stale')
+            return xml_path, meta
+
+        meta['fetched'] = time.time()
+        write_cache_file(meta_path, json.dumps(meta).encode('utf-8'))
+        return xml_path, meta
+
+    return in_flight.do(url, revalidate)
+
+def get_cache_dir():
+    return app.config.get(
+        'OCHRE_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'lucy-cache')
+    )
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a file, which is shared with every
+       other process using the cache directory.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def download(response, cache_dir, feed=None):
+    """Stream a response into a temporary file in cache_dir. Returns
+       the path of the file and the SHA-1 of its contents.
+    """
+    sha1 = hashlib.sha1()
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                sha1.update(chunk)
+                f.write(chunk)
+                if feed is not None:
+                    feed(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, sha1.hexdigest()
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def write_cache_file(path, data):
+    """Write a file atomically, so that other threads never see a
+       partially written cache entry.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    # mkstemp() makes files only their owner can read, but Apache
+    # serves some of these.
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+class SharedCache:
+    """Extracted lessons and resolved audio IRIs, in an SQLite database
+       shared by every mod_wsgi process, so that a lesson is only
+       parsed and an audio resource only looked up once between them.
+       (Raw XML is shared through the files in the cache directory.)
+       The processes' metrics are added up here too.
+
+       The database is SHARED_CACHE, by default lucy.sqlite3 in the
+       cache directory. Since this is only a cache, errors are logged
+       and treated as misses.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def connect(self):
+        path = app.config.get(
+            'SHARED_CACHE',
+            os.path.join(get_cache_dir(), 'lucy.sqlite3')
+        )
+        if getattr(self.local, 'path', None) != path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS lessons '
+                '(uuid TEXT PRIMARY KEY, hash TEXT, data BLOB)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS audio '
+                '(uuid TEXT PRIMARY KEY, iri TEXT)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS metrics '
+                '(kind TEXT, name TEXT, labels TEXT, field TEXT, value REAL, '
+                'PRIMARY KEY (name, labels, field))'
+            )
+            self.local.conn = conn
+            self.local.path = path
+        return self.local.conn
+
+    def get_lesson(self, uuid, hash):
+        """Get the data for a version of a lesson, or None."""
+        try:
+            row = self.connect().execute(
+                'SELECT data FROM lessons WHERE uuid = ? AND hash = ?',
+                (uuid, hash)
+            ).fetchone()
+        except sqlite3.Error:
+            app.logger.exception('Unable to read the shared cache.')
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_lesson(self, uuid, hash, data):
+        try:
+            self.connect().execute(
+                'INSERT OR REPLACE INTO lessons VALUES (?, ?, ?)',
+                (uuid, hash, json.dumps(data).encode('utf-8'))
+            )
+        except sqlite3.Error:
+            app.logger.exception('Unable to write to the shared cache.')
+
+    def get_audio(self, uuids):
+        """Get a dict of audio resource UUID -> IRI, for the UUIDs that
+           have been resolved.
+        """
+        iris = {}
+        try:
+            conn = self.connect()
+            # stay under SQLite's limit on query parameters.
+            for i in range(0, len(uuids), 500):
+                batch = uuids[i:i + 500]
+                iris.update(conn.execute(
+                    'SELECT uuid, iri FROM audio WHERE uuid IN ({})'.format(
+                        ', '.join('?' * len(batch))
+                    ),
+                    batch
+                ))
+        except sqlite3.Error:
+            app.logger.exception('Unable to read the shared cache.')
+        return iris
+
+    def set_audio(self, iris):
+        try:
+            self.connect().executemany(
+                'INSERT OR REPLACE INTO audio VALUES (?, ?)',
+                iris.items()
+            )
+        except sqlite3.Error:
+            app.logger.exception('Unable to write to the shared cache.')
+
+    def add_metrics(self, rows):
+        """Add (kind, name, labels, field, value) rows to the totals."""
+        try:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    'INSERT INTO metrics VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (name, labels, field) '
+                    'DO UPDATE SET value = value + excluded.value',
+                    rows
+                )
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            app.logger.exception('Unable to write to the shared cache.')
+
+    def get_metrics(self):
+        """Get the totals as (kind, name, labels, field, value) rows."""
+        try:
+            return self.connect().execute(
+                'SELECT kind, name, labels, field, value FROM metrics'
+            ).fetchall()
+        except sqlite3.Error:
+            app.logger.exception('Unable to read the shared cache.')
+            return []
+
+
+shared_cache = SharedCache()
+
+class LessonTreeBuilder(ET.TreeBuilder):
+    """An XMLParser target that only builds the parts of a lesson that
+       get_title() and the extractors read: the discourseHierarchy, and
+       the abbreviation in the lesson's identification. Everything else
+       is dropped as it is parsed.
+    """
+    def __init__(self):
+        super().__init__()
+        self.hierarchy = 0
+        self.open = []
+
+    def keep(self, tag):
+        if self.hierarchy or tag == 'discourseHierarchy' or not self.open:
+            return True
+        parent_tag, parent_kept = self.open[-1]
+        if not parent_kept:
+            return False
+        return (
+            tag in ('ochre', 'text') or
+            (tag == 'identification' and parent_tag == 'text') or
+            (tag == 'abbreviation' and parent_tag == 'identification')
+        )
+
+    def start(self, tag, attrs):
+        kept = self.keep(tag)
+        self.open.append((tag, kept))
+        if kept:
+            if tag == 'discourseHierarchy':
+                self.hierarchy += 1
+            return super().start(tag, attrs)
+
+    def end(self, tag):
+        tag, kept = self.open.pop()
+        if kept:
+            if tag == 'discourseHierarchy':
+                self.hierarchy -= 1
+            return super().end(tag)
+
+    def data(self, data):
+        if self.open and self.open[-1][1]:
+            super().data(data)
+
+
+class LessonParser:
+    """Incrementally parse a lesson from chunks of XML, keeping a
+       running SHA-1 of everything it has been fed.
+    """
+    def __init__(self):
+        self.error = None
+        self.parser = ET.XMLParser(target=LessonTreeBuilder())
+        self.sha1 = hashlib.sha1()
+
+    def feed(self, data):
+        self.sha1.update(data)
+        if self.error is None:
+            try:
+                self.parser.feed(data)
+            except ET.ParseError as e:
+                self.error = e
+
+    def close(self):
+        if self.error is not None:
+            raise self.error
+        return ET.ElementTree(self.parser.close())
+
+class SectionIndex:
+    """An index of the sections in a lesson's discourseHierarchy.
+
+       Extractors used to search each section's subtree for the
+       property values that identify its type. This walks the tree once
+       instead, recording every property value UUID found in each
+       section's subtree, along with each section's parent and child
+       sections.
+    """
     def __init__(self, tree):
+        self.children_of = {}
+        self.parent_of = {}
+        self.sections = {}
+        self.values = {}
+        for section in tree.findall('.//discourseHierarchy/section'):
+            for value in self.add(section, None):
+                self.sections.setdefault(value, []).append(section)
+
+    def add(self, section, parent):
+        if section in self.values:
+            return self.values[section]
+        self.parent_of[section] = parent
+        self.children_of[section] = [c for c in section if c.tag == 'section']
+        values = set()
+
+        def walk(e):
+            for child in e:
+                if child.tag == 'section':
+                    values.update(self.add(child, section))
+                    continue
+                if e.tag == 'property' and child.tag == 'value' and child.get('uuid'):
+                    values.add(child.get('uuid'))
+                walk(child)
+
+        walk(section)
+        self.values[section] = values
+        return values
+
+    def find(self, uuid):
+        """Get the top-level sections with a property value UUID."""
+        return self.sections.get(uuid, [])
+
+    def has(self, section, uuid):
+        """Check if a property value UUID appears anywhere in a
+           section.
+        """
+        return uuid in self.values[section]
+
+    def children(self, section):
+        return self.children_of[section]
+
+    def parent(self, section):
+        return self.parent_of[section]
+
+
+class Lucy:
+    # set by extractors that had to leave out content they couldn't
+    # get, e.g. when OCHRE was down.
+    failed = False
+
+    def __init__(self, tree, index=None):
         self.tree = tree
+        if index is None:
+            index = SectionIndex(tree)
+        self.index = index
 
     def get_description(self, section):
         try:
@@ -49,16 +870,15 @@ class BasicSentences(Lucy):
                       ]
         """
         basic_sentences = []
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="8754c696-3359-4ecf-8cf5-7e2d293a26b3"]'):
-                basic_sentences.append({
-                    'abbreviation': self.get_abbreviation(section),
-                    'alternate_transcriptions': self.get_alternate_transcriptions(section),
-                    'breakdowns': self.get_breakdowns(section),
-                    'speaker': self.get_speaker(section),
-                    'transcription': self.get_transcription(section),
-                    'translation': self.get_translation(section)
-                })
+        for section in self.index.find('8754c696-3359-4ecf-8cf5-7e2d293a26b3'):
+            basic_sentences.append({
+                'abbreviation': self.get_abbreviation(section),
+                'alternate_transcriptions': self.get_alternate_transcriptions(section),
+                'breakdowns': self.get_breakdowns(section),
+                'speaker': self.get_speaker(section),
+                'transcription': self.get_transcription(section),
+                'translation': self.get_translation(section)
+            })
         return basic_sentences
 
     def get_abbreviation(self, section):
@@ -121,16 +941,15 @@ class Pronunciations(Lucy):
     def as_list(self):
         pronunciations = []
         i = 1
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall(".//property/value[@uuid='eb1d9fc2-3c4d-4615-ab8e-3065aacc57f2']"):
-                pronunciations.append({
-                    'abbreviation': '{:02d}'.format(i),
-                    'description': self.get_description(section),
-                    'examples': self.get_examples(section),
-                    'notes': self.get_notes(section),
-                    'uuid': self.get_uuid(section)
-                })
-                i += 1
+        for section in self.index.find('eb1d9fc2-3c4d-4615-ab8e-3065aacc57f2'):
+            pronunciations.append({
+                'abbreviation': '{:02d}'.format(i),
+                'description': self.get_description(section),
+                'examples': self.get_examples(section),
+                'notes': self.get_notes(section),
+                'uuid': self.get_uuid(section)
+            })
+            i += 1
         return pronunciations
 
     def get_examples(self, section):
@@ -155,28 +974,42 @@ class Pronunciations(Lucy):
 
 class Grammar(Lucy):
     def as_list(self):
+        sections = self.index.find('fc6b91e0-00f8-4a32-8aed-4934432253de')
+
         grammar_blocks = []
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="fc6b91e0-00f8-4a32-8aed-4934432253de"]'):
-                grammar_blocks.append({
-                    'description': self.get_description(section),
-                    'content': self.get_content(section)
-                })
+        for section, content in zip(sections, self.get_contents(sections)):
+            grammar_blocks.append({
+                'description': self.get_description(section),
+                'content': content
+            })
         return grammar_blocks
 
+    def get_contents(self, sections):
+        """Get the content of every grammar block at once, rather than
+           one OCHRE round-trip after another. A block whose document
+           can't be fetched is left empty.
+        """
+        def get_content(section):
+            try:
+                return self.get_content(section)
+            except Exception:
+                app.logger.exception('Unable to get grammar content.')
+                self.failed = True
+                return ''
+
+        if not sections:
+            return []
+        with timed('grammar'), ThreadPoolExecutor(
+            max_workers=app.config.get('OCHRE_WORKERS', 8)
+        ) as executor:
+            return list(executor.map(get_content, sections))
+
     def get_description(self, section):
         return section.find('./links/resource').text
 
     def get_content(self, section):
         uuid = section.find('./links/resource').get('uuid')
-        content_xml = ET.ElementTree(
-            file=urllib.request.urlopen(
-                '{}/ochre?uuid={}'.format(
-                    app.config['OCHRE_SERVER'],
-                    uuid
-                )
-            )
-        )
+        content_xml = ET.ElementTree(ET.fromstring(fetch_xml(ochre_url(uuid))))
         return content_xml.find('//document').text
 
 class Drills(Lucy):
@@ -216,49 +1049,48 @@ class Drills(Lucy):
             ]
         """
         drills = []
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall(".//property/value[@uuid='0a394087-7e9b-4ad9-a97e-97638008bc97']"):
-                description = section.find('description').text
-                # type G drills contain a "show/hide content" link. 
-                type_g = bool(section.findall(".//property/value[@uuid='071132e4-6159-48b7-b0a9-b8361f9424b5']"))
-                t = ''
-                if type_g:
-                    t = 'G'
-                if section.findall(".//section/transcription/links/resource"):
-                    drills.append({
-                        'description': description,
-                        'drills': self.get_drills(section),
-                        'type': t
-                    })
-                else:
-                    drills.append({
-                        'description': description,
-                        'translations': self.get_translations(section),
-                        'type': t
-                    })
+        for section in self.index.find('0a394087-7e9b-4ad9-a97e-97638008bc97'):
+            description = section.find('description').text
+            # type G drills contain a "show/hide content" link. 
+            type_g = self.index.has(section, '071132e4-6159-48b7-b0a9-b8361f9424b5')
+            t = ''
+            if type_g:
+                t = 'G'
+            if section.findall(".//section/transcription/links/resource"):
+                drills.append({
+                    'description': description,
+                    'drills': self.get_drills(section),
+                    'type': t
+                })
+            else:
+                drills.append({
+                    'description': description,
+                    'translations': self.get_translations(section),
+                    'type': t
+                })
         return drills
 
     def get_drills(self, section):
         drills = []
 
-        for s in section.findall('section'):
+        for s in self.index.children(section):
             column1 = {}
             try:
-                column1['text'] = s.findall('section')[0].find('transcription').find('content').text
+                column1['text'] = self.index.children(s)[0].find('transcription').find('content').text
             except AttributeError:
                 column1['text'] = ''
             try:
-                column1['uuid'] = s.findall('section')[0].find('transcription').find('links').find('resource').get('uuid')
+                column1['uuid'] = self.index.children(s)[0].find('transcription').find('links').find('resource').get('uuid')
             except AttributeError:
                 pass
 
             column2 = {}
             try:
-                column2['text'] = s.findall('section')[1].find('transcription').find('content').text
+                column2['text'] = self.index.children(s)[1].find('transcription').find('content').text
             except AttributeError:
                 column2['text'] = ''
             try:
-                column2['uuid'] = s.findall('section')[1].find('transcription').find('links').find('resource').get('uuid')
+                column2['uuid'] = self.index.children(s)[1].find('transcription').find('links').find('resource').get('uuid')
             except AttributeError:
                 pass
      
@@ -267,7 +1099,7 @@ class Drills(Lucy):
 
     def get_translations(self, section):
         translations = []
-        for translation in section.findall('section'):
+        for translation in self.index.children(section):
             try:
                 translation_str = translation.find('./translation/content').text
             except AttributeError:
@@ -289,14 +1121,13 @@ class ListeningIn(Lucy):
     def as_list(self):
         listening_in = []
         i = 1
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="72eb5e25-0d76-4b70-9c1f-13717a6f9cc5"]'):
-                listening_in.append({
-                    'abbreviation': '{:02d}'.format(i),
-                    'description': section.find('description').text,
-                    'transcriptions': self.get_transcriptions(section)
-                })
-                i += 1
+        for section in self.index.find('72eb5e25-0d76-4b70-9c1f-13717a6f9cc5'):
+            listening_in.append({
+                'abbreviation': '{:02d}'.format(i),
+                'description': section.find('description').text,
+                'transcriptions': self.get_transcriptions(section)
+            })
+            i += 1
         return listening_in
 
     def get_transcriptions(self, section):
@@ -319,34 +1150,33 @@ class Conversation(Lucy):
     def as_list(self):
         conversation_blocks = []
         i = 1
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="c72c2b24-74f2-461a-b4f5-9dae22782da4"]'):
-                if section.findall('.//property/value[@uuid="40d5cb3c-b280-4467-8000-947e297a4521"]'):
-                    conversation_blocks.append({
-                        'abbreviation': '{:02d}'.format(i),
-                        'content': self.get_conversation_stimulus(section),
-                        'heading': 'Conversation Stimulus'
-                    })
-                elif section.findall('.//property/value[@uuid="683d06bb-4064-4e94-8cab-6490276636e0"]'):
-                    question_and_answer_blocks, situation_narrative_blocks = self.get_situation_narrative(section)
-                    conversation_blocks.append({
-                        'abbreviation': '{:02d}'.format(i),
-                        'question_and_answer_content': question_and_answer_blocks,
-                        'situation_narrative_content': situation_narrative_blocks,
-                        'heading': 'Situation Narrative'
-                    })
-                else:
-                    conversation_blocks.append({
-                        'abbreviation': '{:02d}'.format(i),
-                        'description': self.get_description(section),
-                        'heading': ''
-                    })
-                i += 1
+        for section in self.index.find('c72c2b24-74f2-461a-b4f5-9dae22782da4'):
+            if self.index.has(section, '40d5cb3c-b280-4467-8000-947e297a4521'):
+                conversation_blocks.append({
+                    'abbreviation': '{:02d}'.format(i),
+                    'content': self.get_conversation_stimulus(section),
+                    'heading': 'Conversation Stimulus'
+                })
+            elif self.index.has(section, '683d06bb-4064-4e94-8cab-6490276636e0'):
+                question_and_answer_blocks, situation_narrative_blocks = self.get_situation_narrative(section)
+                conversation_blocks.append({
+                    'abbreviation': '{:02d}'.format(i),
+                    'question_and_answer_content': question_and_answer_blocks,
+                    'situation_narrative_content': situation_narrative_blocks,
+                    'heading': 'Situation Narrative'
+                })
+            else:
+                conversation_blocks.append({
+                    'abbreviation': '{:02d}'.format(i),
+                    'description': self.get_description(section),
+                    'heading': ''
+                })
+            i += 1
         return conversation_blocks
 
     def get_conversation_stimulus(self, section):
         blocks = []
-        for subsection in section.findall('section'):
+        for subsection in self.index.children(section):
             blocks.append({
                 'character': self.get_character(subsection),
                 'prompt': self.get_prompt(subsection),
@@ -355,9 +1185,9 @@ class Conversation(Lucy):
         return blocks
 
     def get_character(self, section):
-        for subsection in section.findall('section'):
+        for subsection in self.index.children(section):
             # response
-            if subsection.findall('.//property/value[@uuid="7697db70-3d11-442c-a17b-11339635f0e8"]'):
+            if self.index.has(subsection, '7697db70-3d11-442c-a17b-11339635f0e8'):
                 # speaker
                 for prop in subsection.findall('.//property'):
                     if prop.find('label').get('uuid') == '9dc5fbbe-b8db-417f-b9d4-68efa3576e80':
@@ -365,8 +1195,8 @@ class Conversation(Lucy):
         return ''
 
     def get_prompt(self, section):
-        for subsection in section.findall('section'):
-            if subsection.findall('.//property/value[@uuid="4e64b8a2-a91a-48f9-9d5b-eb6259ba7b9b"]'):
+        for subsection in self.index.children(section):
+            if self.index.has(subsection, '4e64b8a2-a91a-48f9-9d5b-eb6259ba7b9b'):
                 return {
                     'text': subsection.find('transcription').find('content').text,
                     'uuid': subsection.find('transcription').find('links').find('resource').get('uuid')
@@ -374,8 +1204,8 @@ class Conversation(Lucy):
         return {'text': '', 'uuid': '#'}
 
     def get_response(self, section):
-        for subsection in section.findall('section'):
-            if subsection.findall('.//property/value[@uuid="7697db70-3d11-442c-a17b-11339635f0e8"]'):
+        for subsection in self.index.children(section):
+            if self.index.has(subsection, '7697db70-3d11-442c-a17b-11339635f0e8'):
                 return {
                     'text': subsection.find('transcription').find('content').text,
                     'uuid': subsection.find('transcription').find('links').find('resource').get('uuid')
@@ -385,12 +1215,12 @@ class Conversation(Lucy):
     def get_situation_narrative(self, section):
         question_and_answer_blocks = []
         situation_narrative_blocks = []
-        for subsection in section.findall('section'):
+        for subsection in self.index.children(section):
             # question and answer
-            if subsection.findall('.//property/value[@uuid="540679da-02c4-45ea-afee-f045dc2724fe"]'):
-                for subsubsection in subsection.findall('section'):
+            if self.index.has(subsection, '540679da-02c4-45ea-afee-f045dc2724fe'):
+                for subsubsection in self.index.children(subsection):
                     # prompt
-                    if subsubsection.findall('.//property/value[@uuid="4e64b8a2-a91a-48f9-9d5b-eb6259ba7b9b"]'):
+                    if self.index.has(subsubsection, '4e64b8a2-a91a-48f9-9d5b-eb6259ba7b9b'):
                         question_and_answer_block = {}
                         try:
                             question_and_answer_block['prompt'] = {
@@ -403,7 +1233,7 @@ class Conversation(Lucy):
                                 'uuid': ''
                             }
                     # response
-                    elif subsubsection.findall('.//property/value[@uuid="7697db70-3d11-442c-a17b-11339635f0e8"]'):
+                    elif self.index.has(subsubsection, '7697db70-3d11-442c-a17b-11339635f0e8'):
                         try:
                             question_and_answer_block['response'] = {
                                 'text': subsubsection.find('transcription').find('content').text,
@@ -442,14 +1272,13 @@ class Conversation(Lucy):
 
 class Vocabulary(Lucy):
     def as_list(self):
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="a22fdc12-a968-4da8-b96f-0e48002a8473"]'):
-                return self.get_vocabulary_blocks(section)
+        for section in self.index.find('a22fdc12-a968-4da8-b96f-0e48002a8473'):
+            return self.get_vocabulary_blocks(section)
         return []
 
     def get_vocabulary_blocks(self, section):
         vocabulary_blocks = []
-        for vocabulary in section.findall('section'):
+        for vocabulary in self.index.children(section):
             try:
                 vocabulary_blocks.append({
                     'translation': vocabulary.find('./translation/content').text,
@@ -463,135 +1292,1488 @@ class Vocabulary(Lucy):
 class SupplementaryMaterials(Lucy):
     def as_list(self):
         supplementary_materials = []
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="59bf3d38-4a2c-45c2-a07b-07e61cc71774"]'):
-                pass
+        for section in self.index.find('59bf3d38-4a2c-45c2-a07b-07e61cc71774'):
+            pass
         return supplementary_materials
 
 
 class TeachingAids(Lucy):
     def as_list(self):
         teaching_aids = []
-        for section in self.tree.findall('.//discourseHierarchy/section'):
-            if section.findall('.//property/value[@uuid="e03bdf4a-d99d-4fb2-9caa-bf0d5f5d7c26"]'):
-                pass
+        for section in self.index.find('e03bdf4a-d99d-4fb2-9caa-bf0d5f5d7c26'):
+            pass
         return teaching_aids
 
 
-def get_uuids():
-    """Get a list of UUIDs for the entire project."""
+PROJECT_URL = 'http://pi.lib.uchicago.edu/1001/org/ochre/bccb5942-7768-4c0d-aa20-b78bcc970bac'
+
+class UUIDList:
+    """The list of lesson UUIDs for the project, held in memory.
+
+       A background thread fetches the project document when the list is
+       first needed (or when start() is called, e.g. from app.wsgi), and
+       then refreshes it every UUIDS_REFRESH_INTERVAL seconds. Requests
+       never wait for it: until the first copy arrives the list is empty,
+       and if the upstream server is slow or down the last good copy
+       keeps being served.
+
+       The list is kept as a tuple, which is replaced rather than
+       changed, so that it can be shared without copying and anything
+       derived from it (like the sidebar) can be cached until the list
+       itself is replaced.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+        self.uuids = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def get(self, wait=False):
+        """Get the list. If wait is true and the list hasn't been
+           fetched yet, wait for the first attempt to fetch it.
+        """
+        self.start()
+        if wait and self.uuids is None:
+            self.ready.wait()
+        return self.uuids or ()
+
+    def refresh(self, ttl=0):
+        try:
+            uuids = tuple(parse_uuids(fetch_xml(
+                app.config.get('PROJECT_URL', PROJECT_URL),
+                ttl=ttl
+            )))
+        except Exception:
+            app.logger.exception('Unable to refresh the lesson list.')
+            return
+        with self.lock:
+            if uuids != self.uuids:
+                self.uuids = uuids
+
+    def run(self):
+        # a list restored from a snapshot is only fetched again if the
+        # cached project document has expired.
+        self.refresh(ttl=None)
+        self.ready.set()
+        while True:
+            time.sleep(app.config.get('UUIDS_REFRESH_INTERVAL', 15 * 60))
+            self.refresh()
+
+
+uuid_list = UUIDList()
+
+def parse_uuids(xml):
+    """Get the lesson UUIDs from the project document."""
     uuids = []
-    tree = ET.fromstring(
-        urllib.request.urlopen(
-            'http://pi.lib.uchicago.edu/1001/org/ochre/bccb5942-7768-4c0d-aa20-b78bcc970bac'
-        ).read()
-    )
+    tree = ET.fromstring(xml)
     for el in tree.findall('.//text[@uuid]'):
         uuids.append(el.get('uuid'))
     return uuids
 
+def get_uuids(wait=False):
+    """Get a tuple of UUIDs for the entire project. See UUIDList.get()."""
+    return uuid_list.get(wait)
+
+audio_iris = {}
+
+def collect_audio_uuids(blocks):
+    """Get the audio resource UUIDs in the output of an as_list() method,
+       e.g. the 'uuid' of every transcription, translation, prompt and
+       response.
+    """
+    uuids = []
+    if isinstance(blocks, dict):
+        for k, v in blocks.items():
+            if k == 'uuid' and isinstance(v, str):
+                if v not in ('', '#'):
+                    uuids.append(v)
+            else:
+                uuids.extend(collect_audio_uuids(v))
+    elif isinstance(blocks, list):
+        for b in blocks:
+            uuids.extend(collect_audio_uuids(b))
+    return uuids
+
+def get_audio_iri(uuid):
+    """Get the IRI of the audio file for an OCHRE resource."""
+    tree = ET.fromstring(fetch_xml(ochre_url(uuid)))
+    for el in tree.iter():
+        if el.get('iri'):
+            return el.get('iri')
+    return None
+
+class AudioResolver:
+    """Looks up audio IRIs on a pool of OCHRE_WORKERS threads of its
+       own, so that a lookup carries on after the request that wanted it
+       has stopped waiting, and is never made twice at once.
+
+       The pool is only for requests. Background work like prefetching
+       looks audio up on its own threads with resolve(), so that it
+       never queues ahead of a request's lookups.
+    """
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.lookups = {}
+
+    def lookup(self, uuid):
+        """Start looking up an audio resource's IRI, unless that's
+           already under way. Returns a Future.
+        """
+        with self.lock:
+            future = self.lookups.get(uuid)
+            if future is None:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=app.config.get('OCHRE_WORKERS', 8),
+                        thread_name_prefix='audio'
+                    )
+                future = self.lookups[uuid] = self.executor.submit(self.run, uuid)
+            return future
+
+    def resolve(self, uuid):
+        """Look up an audio resource's IRI on this thread, unless that's
+           already under way. Requests that want it meanwhile wait for
+           this lookup.
+        """
+        with self.lock:
+            if uuid in self.lookups:
+                return
+            future = self.lookups[uuid] = Future()
+        try:
+            self.run(uuid)
+        finally:
+            future.set_result(None)
+
+    def run(self, uuid):
+        try:
+            iri = get_audio_iri(uuid)
+            if iri:
+                audio_iris[uuid] = iri
+                shared_cache.set_audio({uuid: iri})
+        except Exception:
+            app.logger.exception('Unable to resolve audio for %s.', uuid)
+        finally:
+            with self.lock:
+                del self.lookups[uuid]
+
+
+audio_resolver = AudioResolver()
+
+def resolve_audio(blocks, timeout=None, background=False):
+    """Look up the audio IRIs for every resource referenced in blocks,
+       concurrently, and remember them in audio_iris. Waits at most
+       timeout seconds (by default, until every lookup is done); lookups
+       that take longer finish in the background. Resources that can't
+       be resolved are left for the next request to try again.
+
+       For background work, pass background=True: resources are then
+       looked up one at a time on the calling thread instead of on the
+       pool that requests wait on.
+
+       Returns whether every resource has been resolved.
+    """
+    all_uuids = set(collect_audio_uuids(blocks))
+    uuids = [u for u in all_uuids if u not in audio_iris]
+    metrics.inc('lucy_cache_requests_total', len(all_uuids) - len(uuids), cache='audio', result='hit')
+    if not uuids:
+        return True
+
+    # other processes may have resolved some of these already.
+    shared = shared_cache.get_audio(uuids)
+    audio_iris.update(shared)
+    uuids = [u for u in uuids if u not in shared]
+    metrics.inc('lucy_cache_requests_total', len(shared), cache='audio', result='shared')
+    metrics.inc('lucy_cache_requests_total', len(uuids), cache='audio', result='miss')
+    if not uuids:
+        return True
+
+    with timed('audio'):
+        if background:
+            for uuid in uuids:
+                audio_resolver.resolve(uuid)
+        else:
+            wait([audio_resolver.lookup(u) for u in uuids], timeout=timeout)
+    return all(u in audio_iris for u in uuids)
+
+class AudioMirror:
+    """The local copies of audio files made by `flask sync-audio`, in
+       AUDIO_DIR, which Apache serves at /audio. manifest.json there
+       maps each audio resource UUID to its file's path, size and
+       SHA-256. The manifest is read again when it changes, checked at
+       most every AUDIO_MANIFEST_CHECK seconds.
+    """
+    def __init__(self):
+        self.checked = 0
+        self.files = {}
+        self.lock = threading.Lock()
+        self.mtime = None
+
+    def path(self, name='manifest.json'):
+        return os.path.join(app.config.get('AUDIO_DIR', '/data/LUCY/audio'), name)
+
+    def manifest(self):
+        with self.lock:
+            if time.time() - self.checked >= app.config.get('AUDIO_MANIFEST_CHECK', 60):
+                self.checked = time.time()
+                try:
+                    mtime = os.path.getmtime(self.path())
+                    if mtime != self.mtime:
+                        with open(self.path()) as f:
+                            self.files = json.load(f)
+                        self.mtime = mtime
+                except (OSError, ValueError):
+                    self.files = {}
+                    self.mtime = None
+            return self.files
+
+    def get(self, uuid):
+        """Get the URL of the local copy of an audio file, or None."""
+        try:
+            return '/audio/' + urllib.parse.quote(self.manifest()[uuid]['path'])
+        except KeyError:
+            return None
+
+    def version(self):
+        """Get a string that changes whenever the manifest does."""
+        self.manifest()
+        return str(self.mtime)
+
+
+audio_mirror = AudioMirror()
+
+@app.template_filter('audio_url')
+def audio_url(uuid):
+    """Get a URL the browser can play directly for an audio resource:
+       the local copy if there is one, or else its file on the OCHRE
+       server. Unresolved resources fall back to their OCHRE URL, which
+       js/lucy.js resolves on the client.
+    """
+    try:
+        return audio_mirror.get(uuid) or audio_iris[uuid]
+    except KeyError:
+        return 'http://ochre.lib.uchicago.edu/ochre?uuid={}'.format(
+            urllib.parse.quote(uuid or '')
+        )
+
+class Sidebar:
+    """The sidebar navigation, which links to every section of every
+       lesson. It only changes when the lesson list does, so it is
+       rendered once per version of the list and then spliced into
+       every page.
+    """
+    def __init__(self):
+        self.cached = (None, None)
+
+    def render(self):
+        uuids = get_uuids()
+        cached_uuids, html = self.cached
+        if cached_uuids is not uuids:
+            html = Markup(render_template('sidebar.html', uuids=uuids))
+            self.cached = (uuids, html)
+        return html
+
+
+sidebar = Sidebar()
+
+@app.template_global('sidebar')
+def sidebar_html():
+    return sidebar.render()
+
+SECTION_NAMES = (
+    'Front Matter',
+    'Basic Sentences',
+    'Pronunciation',
+    'Grammar',
+    'Drills',
+    'Listening In',
+    'Conversation',
+    'Vocabulary',
+    'Supplementary Materials',
+    'Teaching Aids'
+)
+
 def get_title(tree, section):
     """Get section titles."""
     return 'Lesson {}: {}'.format(
         int(tree.find('.//ochre/text/identification/abbreviation').text),
-        (
-            'Front Matter',
-            'Basic Sentences',
-            'Pronunciation',
-            'Grammar',
-            'Drills',
-            'Listening In',
-            'Conversation',
-            'Vocabulary',
-            'Supplementary Materials',
-            'Teaching Aids'
-        )[section]
+        SECTION_NAMES[section]
+    )
+
+class LRUCache:
+    """A thread-safe dict that holds at most size items, dropping the
+       least recently used item first.
+    """
+    def __init__(self, size):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = size
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+                return self.items[key]
+            except KeyError:
+                return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+EXTRACTORS = (
+    None,
+    BasicSentences,
+    Pronunciations,
+    Grammar,
+    Drills,
+    ListeningIn,
+    Conversation,
+    Vocabulary,
+    SupplementaryMaterials,
+    TeachingAids
+)
+
+class Lesson:
+    """Everything the templates need from a lesson. The XML is parsed
+       once and every extractor is run on it, so switching between the
+       sections of a lesson doesn't parse anything.
+    """
+    def __init__(self, uuid, hash, titles, sections, modified=None, failed=()):
+        self.failed = failed
+        self.uuid = uuid
+        self.hash = hash
+        self.modified = modified or int(time.time())
+        self.titles = titles
+        self.sections = sections
+        self.json = {}
+
+    @property
+    def complete(self):
+        """Whether every section was extracted in full. failed lists the
+           sections that weren't.
+        """
+        return not self.failed
+
+    def as_data(self):
+        """Get the lesson as a dict for the shared cache."""
+        return {
+            'modified': self.modified,
+            'sections': self.sections,
+            'titles': self.titles
+        }
+
+    def as_json(self, section):
+        """Get a section as JSON, and gzipped JSON. These are only
+           serialized once per lesson.
+        """
+        try:
+            return self.json[section]
+        except KeyError:
+            data = json.dumps({
+                'blocks': self.sections[section],
+                'section': section,
+                'title': self.titles[section],
+                'uuid': self.uuid
+            }, sort_keys=True).encode('utf-8')
+            self.json[section] = (data, gzip.compress(data, mtime=0))
+            return self.json[section]
+
+
+def extract_lesson(uuid, tree, hash):
+    """Run every extractor on a lesson's XML. If any of them failed to
+       get some of the lesson's content, the lesson isn't complete.
+    """
+    index = SectionIndex(tree)
+    sections = [[]]
+    failed = []
+    for extractor in EXTRACTORS[1:]:
+        with timed('extract'):
+            e = extractor(tree, index)
+            sections.append(e.as_list())
+            if e.failed:
+                failed.append(len(sections) - 1)
+    return Lesson(
+        uuid,
+        hash,
+        [get_title(tree, s) for s in range(len(EXTRACTORS))],
+        sections,
+        failed=tuple(failed)
     )
 
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Get a hash of this file, so that lessons extracted by an older
+       version of the code aren't taken from the shared cache.
+    """
+    return file_sha1(os.path.abspath(__file__))
+
+lesson_cache = LRUCache(app.config.get('LESSON_CACHE_SIZE', 64))
+
+def get_lesson(uuid):
+    """Get a lesson, rebuilding it only when its XML has changed.
+
+       A lesson that has to be downloaded is parsed as it arrives.
+       Otherwise it is parsed from the cached copy on disk. Concurrent
+       requests for the same lesson share one build.
+    """
+    return in_flight.do(('lesson', uuid), lambda: load_lesson(uuid))
+
+def load_lesson(uuid):
+    parser = LessonParser()
+    with timed('fetch'):
+        xml_path, meta = fetch_xml_file(ochre_url(uuid), feed=parser.feed)
+    lesson = lesson_cache.get(uuid)
+    if lesson is not None and lesson.hash == meta['sha1']:
+        metrics.inc('lucy_cache_requests_total', cache='lesson', result='hit')
+        return lesson
+
+    # another process may have extracted this version of the lesson.
+    shared_key = '{}-{}'.format(meta['sha1'], code_version())
+    data = shared_cache.get_lesson(uuid, shared_key)
+    if data is not None:
+        metrics.inc('lucy_cache_requests_total', cache='lesson', result='shared')
+        lesson = Lesson(uuid, meta['sha1'], **data)
+    else:
+        metrics.inc('lucy_cache_requests_total', cache='lesson', result='miss')
+        with timed('parse'):
+            if parser.sha1.hexdigest() != meta['sha1']:
+                parser = LessonParser()
+                with open(xml_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        parser.feed(chunk)
+            tree = parser.close()
+        lesson = extract_lesson(uuid, tree, meta['sha1'])
+        if not lesson.complete:
+            # serve what there is, but only to this request: the next
+            # one tries again. Indexes that don't use the sections that
+            # failed can still have it.
+            metrics.inc('lucy_incomplete_lessons_total')
+            search_index.add(lesson)
+            lexicon.add(lesson)
+            return lesson
+        shared_cache.set_lesson(uuid, shared_key, lesson.as_data())
+    lesson_cache.set(uuid, lesson)
+    search_index.add(lesson)
+    lexicon.add(lesson)
+    return lesson
+
+# sections whose templates link to audio.
+AUDIO_SECTIONS = (1, 2, 4, 5, 6)
+
+class Prefetcher:
+    """Warm the caches for the pages a student is likely to ask for
+       next: the audio for every section of the lesson they are reading,
+       and the lesson after it, along with its grammar blocks and audio.
+
+       Work runs on a small pool of its own, never on request threads,
+       and only waits on OCHRE fetches and lesson builds. Audio is looked
+       up on that pool too, never on the one requests wait on. At most
+       PREFETCH_QUEUE_SIZE lessons wait to be prefetched; beyond that,
+       new ones are dropped. Each version of a lesson is only prefetched
+       once.
+    """
+    def __init__(self):
+        self.done = LRUCache(app.config.get('LESSON_CACHE_SIZE', 64))
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def after(self, lesson):
+        """Prefetch around a lesson that has just been served."""
+        if not app.config.get('PREFETCH', True):
+            return
+        uuids = get_uuids()
+        try:
+            i = uuids.index(lesson.uuid)
+        except ValueError:
+            return
+        self.submit(lesson.uuid, lesson.hash)
+        if i + 1 < len(uuids):
+            self.submit(uuids[i + 1])
+
+    def submit(self, uuid, hash=None):
+        if hash is not None and self.done.get((uuid, hash)):
+            return
+        with self.lock:
+            if uuid in self.pending:
+                return
+            if len(self.pending) >= app.config.get('PREFETCH_QUEUE_SIZE', 16):
+                metrics.inc('lucy_prefetch_total', result='dropped')
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=app.config.get('PREFETCH_WORKERS', 2),
+                    thread_name_prefix='prefetch'
+                )
+            self.pending.add(uuid)
+        metrics.inc('lucy_prefetch_total', result='queued')
+        self.executor.submit(self.run, uuid)
+
+    def run(self, uuid):
+        try:
+            with timed('prefetch'):
+                lesson = get_lesson(uuid)
+                if not self.done.get((uuid, lesson.hash)):
+                    for section in AUDIO_SECTIONS:
+                        resolve_audio(lesson.sections[section], background=True)
+                    self.done.set((uuid, lesson.hash), True)
+        except Exception:
+            app.logger.exception('Unable to prefetch %s.', uuid)
+        finally:
+            with self.lock:
+                self.pending.discard(uuid)
+
+
+prefetcher = Prefetcher()
+
+# sections covered by search: basic sentences, pronunciation, grammar,
+# drills and vocabulary.
+SEARCH_SECTIONS = (1, 2, 3, 4, 7)
+
+def normalize(text):
+    """Fold text for searching: lowercase, without accents or other
+       diacritics, and with every kind of apostrophe (which marks a
+       glottal stop in Maya) written as '.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.sub('[‘’ʼ`´]', "'", text)
+
+def tokenize(text):
+    """Split text into search terms, keeping glottal stops: e.g.
+       "Ma'alob, kux teech?" -> ["ma'alob", 'kux', 'teech'].
+    """
+    return [t.strip("'") for t in re.findall(r"[\w']+", normalize(text)) if t.strip("'")]
+
+def collect_text(blocks):
+    """Get the text in the output of an as_list() method, leaving out
+       UUIDs and markup.
+    """
+    text = []
+    if isinstance(blocks, dict):
+        # put the main text first, since results show the start of it.
+        for k in sorted(blocks, key=lambda k: k not in ('description', 'transcription', 'translation')):
+            if k not in ('abbreviation', 'type', 'uuid'):
+                text.extend(collect_text(blocks[k]))
+    elif isinstance(blocks, list):
+        for b in blocks:
+            text.extend(collect_text(b))
+    elif isinstance(blocks, str):
+        text.append(' '.join(unescape_html(re.sub('<[^>]*>', ' ', blocks)).split()))
+    return [t for t in text if t]
+
+class LessonIndex:
+    """Data derived from every lesson, such as the search index. Each
+       lesson's entry is stored in a JSON file of its own, along with
+       the SHA-1 of the lesson's XML, so that only lessons that have
+       changed are processed again, and processes never overwrite each
+       other's updates. The files are read once, and then kept in
+       memory.
+
+       Requests don't wait for lessons to be added: start_update()
+       adds missing ones in the background, and until then they're left
+       out.
+
+       Subclasses set the setting for the directory, and its default
+       name in the cache directory, and the sections entry() uses, and
+       implement entry().
+    """
+    setting = None
+    dir_name = None
+    sections = ()
+
+    def __init__(self):
+        self.lessons = {}
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.updated = 0
+        self.updating = False
+
+    def path(self, uuid=None):
+        index_dir = app.config.get(
+            self.setting,
+            os.path.join(get_cache_dir(), self.dir_name)
+        )
+        if uuid is None:
+            return index_dir
+        return os.path.join(index_dir, uuid + '.json')
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                names = os.listdir(self.path())
+            except OSError:
+                names = []
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.path(), name)) as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self.set(name[:-len('.json')], entry)
+            self.loaded = True
+
+    def entry(self, lesson):
+        """Get the entry for a lesson, a dict that can be saved as JSON."""
+        raise NotImplementedError
+
+    def set(self, uuid, entry):
+        self.lessons[uuid] = entry
+
+    def add(self, lesson):
+        """Add a lesson, unless this version of it is already here or
+           some of the sections used here couldn't be loaded.
+        """
+        if set(lesson.failed) & set(self.sections):
+            return
+        self.load()
+        with self.lock:
+            if self.lessons.get(lesson.uuid, {}).get('hash') == lesson.hash:
+                return
+            entry = dict(self.entry(lesson), hash=lesson.hash)
+            self.set(lesson.uuid, entry)
+        try:
+            write_cache_file(self.path(lesson.uuid), json.dumps(entry).encode('utf-8'))
+        except OSError:
+            app.logger.exception('Unable to save %s.', self.path(lesson.uuid))
+
+    def update(self, uuids):
+        """Add any of the given lessons that haven't been yet,
+           concurrently.
+        """
+        self.load()
+        missing = [u for u in uuids if u not in self.lessons]
+        if not missing:
+            return
+
+        def add(uuid):
+            try:
+                self.add(get_lesson(uuid))
+            except Exception:
+                app.logger.exception('Unable to add lesson %s.', uuid)
+
+        with ThreadPoolExecutor(
+            max_workers=app.config.get('OCHRE_WORKERS', 8)
+        ) as executor:
+            list(executor.map(add, missing))
+
+    def start_update(self, uuids):
+        """Start adding any of the given lessons that haven't been yet
+           on a background thread, unless that's already under way. While
+           some of them can't be added, e.g. because OCHRE is down, this
+           is tried at most every INDEX_RETRY_INTERVAL seconds.
+        """
+        self.load()
+        with self.lock:
+            if all(u in self.lessons for u in uuids):
+                return
+            if self.updating or time.time() - self.updated < app.config.get('INDEX_RETRY_INTERVAL', 60):
+                return
+            self.updating = True
+
+        def run():
+            try:
+                self.update(uuids)
+            except Exception:
+                app.logger.exception('Unable to update %s.', self.path())
+            finally:
+                with self.lock:
+                    self.updated = time.time()
+                    self.updating = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class SearchIndex(LessonIndex):
+    """A full-text index of every lesson's sentences, pronunciation
+       examples, grammar, drills and vocabulary. Each block of a section
+       (a basic sentence, a grammar note, a set of drills...) is a
+       document. Lessons' text is stored in SEARCH_INDEX_DIR, and the
+       inverted index is kept in memory.
+    """
+    setting = 'SEARCH_INDEX_DIR'
+    dir_name = 'search'
+    sections = SEARCH_SECTIONS
+
+    def __init__(self):
+        super().__init__()
+        self.docs = {}
+        self.postings = {}
+
+    def entry(self, lesson):
+        return {
+            'docs': [
+                (section, ' / '.join(collect_text(block)))
+                for section in SEARCH_SECTIONS
+                for block in lesson.sections[section]
+            ],
+            'title': lesson.titles[0].split(':')[0]
+        }
+
+    def set(self, uuid, entry):
+        """Replace the documents for a lesson in the inverted index."""
+        for i in range(len(self.lessons.get(uuid, {}).get('docs', []))):
+            for token in set(tokenize(self.docs[uuid, i][1])):
+                postings = self.postings[token]
+                postings.pop((uuid, i), None)
+                if not postings:
+                    del self.postings[token]
+            del self.docs[uuid, i]
+        super().set(uuid, entry)
+        for i, (section, text) in enumerate(entry['docs']):
+            self.docs[uuid, i] = (section, text)
+            for token in tokenize(text):
+                postings = self.postings.setdefault(token, {})
+                postings[uuid, i] = postings.get((uuid, i), 0) + 1
+
+    def search(self, query, uuids, limit=50):
+        """Find the documents in the given lessons that contain every
+           word of the query, best matches first. Documents with the
+           words of the query in order rank above the rest.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        order = {u: i for i, u in enumerate(uuids)}
+        results = []
+        with self.lock:
+            matches = None
+            for term in set(terms):
+                docs = set(self.postings.get(term, ()))
+                matches = docs if matches is None else matches & docs
+            for key in matches:
+                uuid, i = key
+                if uuid not in order:
+                    continue
+                section, text = self.docs[key]
+                tokens = tokenize(text)
+                phrase = any(
+                    tokens[j:j + len(terms)] == terms
+                    for j in range(len(tokens) - len(terms) + 1)
+                )
+                score = sum(self.postings[t][key] for t in terms) + (10 if phrase else 0)
+                results.append({
+                    'score': score,
+                    'section': section,
+                    'text': text,
+                    'title': '{}: {}'.format(
+                        self.lessons[uuid]['title'],
+                        SECTION_NAMES[section]
+                    ),
+                    'uuid': uuid,
+                    'order': (order[uuid], section, i)
+                })
+        results.sort(key=lambda r: (-r['score'], r['order']))
+        for r in results:
+            del r['order']
+        return results[:limit]
+
+
+search_index = SearchIndex()
+
+class Lexicon(LessonIndex):
+    """Every Maya word and phrase in the course with its English, from
+       the lessons' vocabulary and the breakdowns of their basic
+       sentences, sorted and without duplicates. Lessons' entries are
+       stored in LEXICON_DIR as [Maya, English, section] lists.
+
+       The page is rendered again only when a lesson's entries, the
+       lesson list or the templates change.
+    """
+    setting = 'LEXICON_DIR'
+    dir_name = 'lexicon'
+    sections = (1, 7)
+
+    def __init__(self):
+        super().__init__()
+        self.page = None
+        self.version = None
+
+    def entry(self, lesson):
+        def clean(text):
+            return (text or '').strip().strip('.,;:?!¿¡"').strip()
+
+        words = []
+        for block in lesson.sections[7]:
+            words.append((clean(block['transcription']), clean(block['translation']), 7))
+        for block in lesson.sections[1]:
+            for breakdown in block['breakdowns']:
+                words.append((
+                    clean(breakdown['transcription']['text']),
+                    clean(breakdown['translation']['text']),
+                    1
+                ))
+        return {'words': [w for w in words if w[0] and w[1]]}
+
+    def set(self, uuid, entry):
+        super().set(uuid, entry)
+        self.version = None
+
+    def words(self, uuids):
+        """Get the words from the given lessons, sorted by their Maya
+           and then their English, ignoring case and accents. Each word
+           has a list of (lesson number, UUID, section) to link to.
+        """
+        words = {}
+        with self.lock:
+            for n, uuid in enumerate(uuids, 1):
+                for transcription, translation, section in self.lessons.get(uuid, {}).get('words', []):
+                    key = (normalize(transcription), normalize(translation))
+                    word = words.setdefault(key, {
+                        'lessons': [],
+                        'transcription': transcription,
+                        'translation': translation
+                    })
+                    if not word['lessons'] or word['lessons'][-1][0] != n:
+                        word['lessons'].append((n, uuid, section))
+        return [words[key] for key in sorted(words)]
+
+    def render(self, uuids):
+        """Get the lexicon page as HTML, with the lessons that have been
+           added so far.
+        """
+        self.start_update(uuids)
+        with self.lock:
+            version = hashlib.sha1(' '.join(
+                [template_version()] + list(uuids) +
+                [self.lessons.get(u, {}).get('hash', '') for u in uuids]
+            ).encode('utf-8')).hexdigest()
+            if self.version != version:
+                self.page = render_template(
+                    'lexicon.html',
+                    title='Lexicon',
+                    words=self.words(uuids)
+                )
+                self.version = version
+            return self.page
+
+
+lexicon = Lexicon()
+
+DEFAULT_UUID = '0ad43a89-09d6-4292-88cb-b6fd6dfe41e5'
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+def check_lesson_uuid(uuid):
+    """Abort with a 404 unless a UUID from a request is a lesson's, so
+       that requests can't fill the cache directory with documents
+       that aren't lessons. Until the lesson list has been fetched, any
+       well-formed UUID is let through.
+    """
+    if not UUID_RE.match(uuid):
+        abort(404)
+    uuids = get_uuids()
+    if uuids and uuid not in uuids and uuid != DEFAULT_UUID:
+        abort(404)
+
 @app.route("/")
 def lucy():
-    uuid = request.args.get('uuid', default='0ad43a89-09d6-4292-88cb-b6fd6dfe41e5')
+    uuid = request.args.get('uuid', default=DEFAULT_UUID)
     section = int(request.args.get('section', default=0))
+    check_lesson_uuid(uuid)
 
-    ochre_xml = ET.ElementTree(
-        file=urllib.request.urlopen(
-            '{}/ochre?uuid={}'.format(
-                app.config['OCHRE_SERVER'],
-                uuid
-            )
-        )
+    lesson = get_lesson(uuid)
+
+    # Pages only change when the lesson, the templates, the local audio
+    # files or the lesson list in the sidebar do, so a conditional
+    # request can be answered without rendering anything. There's no
+    # Last-Modified: a request with only If-Modified-Since would be
+    # answered from the date alone, and there's no one date that
+    # covers all of those. The ETag is only sent with complete pages
+    # (see below), so it stands for this version of the page with
+    # nothing missing.
+    response = app.response_class()
+    response.set_etag(hashlib.sha1(' '.join(
+        [lesson.hash, str(section), code_version(), template_version(), audio_mirror.version()]
+        + list(get_uuids())
+    ).encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = 'public, max-age={}, stale-while-revalidate={}'.format(
+        app.config.get('PAGE_MAX_AGE', 5 * 60),
+        app.config.get('PAGE_STALE_WHILE_REVALIDATE', 24 * 60 * 60)
+    )
+    response.make_conditional(request)
+    if response.status_code == 304:
+        metrics.inc('lucy_cache_requests_total', cache='page', result='hit')
+    else:
+        metrics.inc('lucy_cache_requests_total', cache='page', result='miss')
+        # audio that takes longer to look up than this is linked to
+        # through OCHRE, for js/lucy.js to resolve.
+        complete = lesson.complete
+        if section in AUDIO_SECTIONS:
+            complete = resolve_audio(
+                lesson.sections[section],
+                timeout=app.config.get('AUDIO_RESOLVE_TIMEOUT', 0.5)
+            ) and complete
+        with timed('render'):
+            response.set_data(render_section(lesson, section))
+        if not complete:
+            # a page with content or audio links missing is only for
+            # this request: nothing may keep it, or revalidate it
+            # against the complete page's ETag.
+            del response.headers['ETag']
+            response.headers['Cache-Control'] = 'no-store'
+    prefetcher.after(lesson)
+    return response
+
+@app.route("/api/lesson/<uuid>/<int:section>")
+def api_lesson(uuid, section):
+    """Get the output of a section's extractor as JSON. Responses carry
+       a strong ETag, so clients can revalidate them with
+       If-None-Match.
+    """
+    if not 0 < section < len(EXTRACTORS):
+        abort(404)
+    check_lesson_uuid(uuid)
+
+    lesson = get_lesson(uuid)
+    prefetcher.after(lesson)
+    data, gzipped = lesson.as_json(section)
+    etag = hashlib.sha1(data).hexdigest()
+    response = app.response_class(mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip']:
+        response.set_data(gzipped)
+        response.content_encoding = 'gzip'
+        etag += '-gzip'
+    else:
+        response.set_data(data)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+class ZipStream:
+    """A write-only file for zipfile.ZipFile that collects what is
+       written to it until it is drained, so that a zip file can be
+       sent as it is made.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def lookahead(fn, items, size):
+    """Call fn on each item, up to size at once in the background, and
+       yield (item, future) pairs in order. Unlike Executor.map(), this
+       never holds more than size results at a time.
+    """
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = []
+        for item in items:
+            futures.append((item, executor.submit(fn, item)))
+            if len(futures) == size:
+                yield futures.pop(0)
+        while futures:
+            yield futures.pop(0)
+
+def export_course(uuids, format='json', audio=False):
+    """Generate a zip file of every section of every lesson, one chunk
+       at a time. Sections are saved as lessonNN/SS.json, the output of
+       /api/lesson, or with format='html' as lessonNN/SS.html, the
+       page. If audio is true, lessonNN/audio.json maps each audio
+       resource UUID in a lesson to the IRI of its file. (HTML pages
+       always link to the audio files they can.)
+
+       Lessons are fetched OCHRE_WORKERS at a time, ahead of the one
+       being written out, and each section is sent as soon as it has
+       been added to the zip file.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as z:
+        for n, (uuid, future) in enumerate(lookahead(
+            get_lesson, uuids, app.config.get('OCHRE_WORKERS', 8)
+        ), 1):
+            try:
+                lesson = future.result()
+            except Exception:
+                app.logger.exception('Unable to export lesson %s.', uuid)
+                continue
+            date_time = time.localtime(lesson.modified)[:6]
+            if format == 'html' or audio:
+                for section in AUDIO_SECTIONS:
+                    resolve_audio(lesson.sections[section])
+            for section in range(1, len(EXTRACTORS)):
+                if format == 'html':
+                    name = 'lesson{:02d}/{:02d}.html'.format(n, section)
+                    data = render_section(lesson, section).encode('utf-8')
+                else:
+                    name = 'lesson{:02d}/{:02d}.json'.format(n, section)
+                    data = lesson.as_json(section)[0]
+                z.writestr(zipfile.ZipInfo(name, date_time), data, zipfile.ZIP_DEFLATED)
+                yield stream.drain()
+            if audio:
+                uuids = set()
+                for section in AUDIO_SECTIONS:
+                    uuids.update(collect_audio_uuids(lesson.sections[section]))
+                z.writestr(
+                    zipfile.ZipInfo('lesson{:02d}/audio.json'.format(n), date_time),
+                    json.dumps({u: audio_iris.get(u) for u in sorted(uuids)}),
+                    zipfile.ZIP_DEFLATED
+                )
+                yield stream.drain()
+    yield stream.drain()
+
+@app.route("/export")
+def export():
+    """Download the whole course as a zip file. See export_course()."""
+    format = request.args.get('format', default='json')
+    if format not in ('html', 'json'):
+        abort(404)
+    response = app.response_class(
+        stream_with_context(export_course(
+            get_uuids(),
+            format,
+            request.args.get('audio', type=int, default=0) == 1
+        )),
+        mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename=lucy-{}.zip'.format(format)
+    return response
+
+@app.route("/search")
+def search():
+    query = request.args.get('q', default='')
+    results = []
+    if query:
+        uuids = get_uuids()
+        search_index.start_update(uuids)
+        with timed('search'):
+            results = search_index.search(query, uuids)
+    return render_template(
+        'search.html',
+        query=query,
+        results=results,
+        title='Search'
     )
 
+@app.route("/lexicon")
+def lexicon_view():
+    with timed('render'):
+        return lexicon.render(get_uuids())
+
+@app.route("/api/search")
+def api_search():
+    """Search every lesson that has been indexed so far. Returns the
+       best matching blocks as JSON: their lesson UUID, section, title
+       and text.
+    """
+    uuids = get_uuids()
+    search_index.start_update(uuids)
+    with timed('search'):
+        results = search_index.search(request.args.get('q', default=''), uuids)
+    return {'results': results}
+
+def render_section(lesson, section):
+    """Render one section of a lesson as HTML. Audio is linked to
+       directly if it has been looked up with resolve_audio().
+    """
     if section == 0:
         return render_template(
             'front_matter.html',
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            title=lesson.titles[section]
         )
     elif section == 1:
         return render_template(
             'basic_sentences.html',
-            basic_sentences=BasicSentences(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            basic_sentences=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 2:
         return render_template(
             'pronunciation.html',
-            blocks=Pronunciations(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 3:
         return render_template(
             'grammar.html',
-            blocks=Grammar(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 4:
         return render_template(
             'drills.html',
-            blocks=Drills(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 5:
         return render_template(
             'listening_in.html',
-            blocks=ListeningIn(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 6:
         return render_template(
             'conversation.html',
-            blocks=Conversation(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 7:
         return render_template(
             'vocabulary.html',
-            blocks=Vocabulary(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 8:
         return render_template(
             'supplementary_materials.html',
-            blocks=SupplementaryMaterials(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
     elif section == 9:
         return render_template(
             'teaching_aids.html',
-            blocks=TeachingAids(ochre_xml).as_list(),
-            title=get_title(ochre_xml, section),
-            uuids=get_uuids()
+            blocks=lesson.sections[section],
+            title=lesson.titles[section]
         )
 
+@functools.lru_cache(maxsize=None)
+def template_version():
+    """Get a hash of the templates, which changes whenever one of them
+       is edited.
+    """
+    sha1 = hashlib.sha1()
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(template_dir)):
+        sha1.update(name.encode('utf-8'))
+        sha1.update(file_sha1(os.path.join(template_dir, name)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def write_static_page(path, html):
+    """Write a pre-rendered page, along with gzip and (if the brotli
+       package is installed) brotli compressed copies for Apache to
+       serve to clients that accept them.
+    """
+    data = html.encode('utf-8')
+    write_cache_file(path, data)
+    write_cache_file(path + '.gz', gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        write_cache_file(path + '.br', brotli.compress(data))
+
+@app.cli.command('build')
+@click.option('--output', default=lambda: app.config.get('BUILD_DIR', 'build'),
+              help='Directory to write the static site to.')
+@click.option('--workers', type=int,
+              default=lambda: app.config.get('OCHRE_WORKERS', 8),
+              help='Number of lessons to build at once.')
+@click.option('--force', is_flag=True,
+              help='Rebuild every lesson, even if it hasn\'t changed.')
+def build(output, workers, force):
+    """Pre-render every section of every lesson as static HTML.
+
+       Pages are written to OUTPUT/<uuid>/<section>.html, with the front
+       page at OUTPUT/index.html. OUTPUT/manifest.json records what each
+       lesson was built from, so that later builds only re-render
+       lessons whose XML has changed. Changing the templates, the local
+       audio files or the lesson list (which appears in every page's
+       sidebar) rebuilds everything. Lessons with content that couldn't
+       be loaded are left out, and their old pages removed, so that the
+       app serves them until the next build.
+    """
+    manifest_path = os.path.join(output, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    uuids = get_uuids(wait=True)
+    version = hashlib.sha1(
+        (template_version() + audio_mirror.version() + ' '.join(uuids)).encode('utf-8')
+    ).hexdigest()
+    if force or manifest.get('version') != version:
+        manifest = {'lessons': {}, 'version': version}
+
+    def build_lesson(uuid):
+        with app.app_context():
+            lesson = get_lesson(uuid)
+            if manifest['lessons'].get(uuid) == lesson.hash:
+                return uuid, lesson.hash, False
+            if not lesson.complete:
+                app.logger.error('Leaving out lesson %s, which is incomplete.', uuid)
+                shutil.rmtree(os.path.join(output, uuid), ignore_errors=True)
+                if uuid == DEFAULT_UUID:
+                    for ext in ('', '.gz', '.br'):
+                        try:
+                            os.remove(os.path.join(output, 'index.html' + ext))
+                        except FileNotFoundError:
+                            pass
+                return uuid, None, False
+            for section in AUDIO_SECTIONS:
+                resolve_audio(lesson.sections[section])
+            for section in range(len(EXTRACTORS)):
+                write_static_page(
+                    os.path.join(output, uuid, '{}.html'.format(section)),
+                    render_section(lesson, section)
+                )
+            if uuid == DEFAULT_UUID:
+                write_static_page(
+                    os.path.join(output, 'index.html'),
+                    render_section(lesson, 0)
+                )
+            return uuid, lesson.hash, True
+
+    built = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_lesson, uuid) for uuid in uuids]
+        for future in futures:
+            try:
+                uuid, hash, rebuilt = future.result()
+            except Exception:
+                app.logger.exception('Unable to build a lesson.')
+                continue
+            manifest['lessons'][uuid] = hash
+            if rebuilt:
+                built += 1
+
+    write_cache_file(manifest_path, json.dumps(manifest).encode('utf-8'))
+    click.echo('Built {} of {} lessons in {}.'.format(built, len(uuids), output))
+
+@app.cli.command('sync-audio')
+@click.option('--workers', type=int,
+              default=lambda: app.config.get('OCHRE_WORKERS', 8),
+              help='Number of files to download at once.')
+@click.option('--verify', is_flag=True,
+              help='Check the SHA-256 of every local file, not just its size.')
+def sync_audio(workers, verify):
+    """Copy every audio file the lessons link to into AUDIO_DIR.
+
+       Files are named after their resource UUIDs, and listed in
+       AUDIO_DIR/manifest.json with their size and SHA-256, for
+       AudioMirror. Files already in the manifest are only downloaded
+       again if they are missing or don't match it. A download that is
+       cut short is discarded.
+    """
+    try:
+        with open(audio_mirror.path()) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    uuids = set()
+    for uuid in get_uuids(wait=True):
+        try:
+            lesson = get_lesson(uuid)
+        except Exception:
+            app.logger.exception('Unable to get lesson %s.', uuid)
+            continue
+        for section in AUDIO_SECTIONS:
+            resolve_audio(lesson.sections[section])
+            uuids.update(collect_audio_uuids(lesson.sections[section]))
+
+    def check(entry):
+        path = audio_mirror.path(entry['path'])
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+        except OSError:
+            return False
+        return not verify or file_sha256(path) == entry['sha256']
+
+    def download_audio(uuid):
+        iri = audio_iris[uuid]
+        ext = os.path.splitext(urllib.parse.urlsplit(iri).path)[1]
+        name = uuid + ext
+        sha256 = hashlib.sha256()
+        size = 0
+        os.makedirs(audio_mirror.path(''), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=audio_mirror.path(''))
+        try:
+            with os.fdopen(fd, 'wb') as f, http_client.get(iri, timeout=60) as response:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                length = response.getheader('Content-Length')
+            if length is not None and int(length) != size:
+                raise OSError('Expected {} bytes from {}, got {}.'.format(length, iri, size))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, audio_mirror.path(name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return {'iri': iri, 'path': name, 'sha256': sha256.hexdigest(), 'size': size}
+
+    missing = [
+        u for u in sorted(uuids)
+        if u in audio_iris and not (u in manifest and check(manifest[u]))
+    ]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_audio, u): u for u in missing}
+        for future in futures:
+            try:
+                manifest[futures[future]] = future.result()
+            except Exception:
+                app.logger.exception('Unable to download audio for %s.', futures[future])
+                manifest.pop(futures[future], None)
+                failed += 1
+
+    write_cache_file(audio_mirror.path(), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    click.echo('Downloaded {} of {} audio files, {} failed, {} unresolved.'.format(
+        len(missing) - failed,
+        len(uuids),
+        failed,
+        len([u for u in uuids if u not in audio_iris])
+    ))
+
+@app.cli.command('index')
+def index():
+    """Build the search index and the lexicon for every lesson, so
+       that the first requests for them don't have to wait for lessons
+       to be fetched.
+    """
+    uuids = get_uuids(wait=True)
+    search_index.update(uuids)
+    lexicon.update(uuids)
+    click.echo('Indexed {} of {} lessons in {}.'.format(
+        len([u for u in uuids if u in search_index.lessons]),
+        len(uuids),
+        search_index.path()
+    ))
+
+@app.cli.command('export')
+@click.option('--output', default='lucy.zip', help='File to write the zip file to.')
+@click.option('--format', type=click.Choice(['json', 'html']), default='json',
+              help='Save sections as JSON data or as HTML pages.')
+@click.option('--audio', is_flag=True,
+              help='Include the audio file IRIs for every lesson.')
+def export_command(output, format, audio):
+    """Export the whole course as a zip file. See export_course()."""
+    with app.app_context(), open(output, 'wb') as f:
+        for chunk in export_course(get_uuids(wait=True), format, audio):
+            f.write(chunk)
+    click.echo('Exported the course to {}.'.format(output))
+
+def snapshot_path():
+    """Get the snapshot's path: SNAPSHOT, by default lucy-snapshot.zip
+       next to this file, so that it doesn't depend on the working
+       directory, which under mod_wsgi isn't the app's.
+    """
+    return app.config.get(
+        'SNAPSHOT',
+        os.path.join(app.root_path, 'lucy-snapshot.zip')
+    )
+
+@app.cli.command('snapshot')
+@click.option('--output', default=snapshot_path,
+              help='File to write the snapshot to.')
+def snapshot(output):
+    """Save the caches to a file, for restore_snapshot() to load when the
+       app starts.
+
+       The snapshot holds the lesson list, every cached OCHRE document,
+       every lesson's extracted sections and the audio IRIs they link
+       to. Lessons that aren't cached yet are fetched first.
+    """
+    uuids = get_uuids(wait=True)
+    lessons = []
+    for uuid in uuids:
+        try:
+            lesson = get_lesson(uuid)
+        except Exception:
+            app.logger.exception('Unable to get lesson %s.', uuid)
+            continue
+        if not lesson.complete:
+            app.logger.error('Leaving out lesson %s, which is incomplete.', uuid)
+            continue
+        for section in AUDIO_SECTIONS:
+            resolve_audio(lesson.sections[section])
+        lessons.append(lesson)
+
+    cache_dir = get_cache_dir()
+    tmp_path = output + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('uuids.json', json.dumps(uuids))
+        z.writestr('version', code_version())
+        z.writestr('audio.json', json.dumps(audio_iris))
+        for lesson in lessons:
+            z.writestr(
+                'lessons/{}.json'.format(lesson.uuid),
+                json.dumps(dict(lesson.as_data(), hash=lesson.hash))
+            )
+        for name in sorted(os.listdir(cache_dir)):
+            if name.endswith('.json'):
+                xml_name = name[:-len('.json')] + '.xml'
+                # write the document first: restore_snapshot() writes
+                # files in order, and a cache entry is its metadata.
+                z.write(os.path.join(cache_dir, xml_name), 'xml/' + xml_name)
+                z.write(os.path.join(cache_dir, name), 'xml/' + name)
+    os.replace(tmp_path, output)
+    click.echo('Saved {} lessons to {}.'.format(len(lessons), output))
+
+def restore_snapshot(path=None):
+    """Load a snapshot made with `flask snapshot`, so that a freshly
+       started process can serve pages without waiting on OCHRE. Call
+       it at import time, e.g. from app.wsgi.
+
+       Restored documents keep the time they were fetched, so they are
+       revalidated against OCHRE as usual once they are older than
+       OCHRE_CACHE_TTL, and lessons that have changed are rebuilt then.
+       Extracted lessons are only restored if the snapshot was made by
+       the same version of this file. Documents already in the cache
+       aren't overwritten.
+    """
+    path = path or snapshot_path()
+    if not os.path.exists(path):
+        app.logger.warning('No snapshot at %s to restore.', path)
+        return
+    try:
+        cache_dir = get_cache_dir()
+        with zipfile.ZipFile(path) as z:
+            for name in z.namelist():
+                if not name.startswith('xml/'):
+                    continue
+                cache_path = os.path.join(cache_dir, os.path.basename(name))
+                if name.endswith('.json'):
+                    if os.path.exists(cache_path):
+                        continue
+                    write_cache_file(cache_path, z.read(name))
+                elif not os.path.exists(cache_path[:-len('.xml')] + '.json'):
+                    write_cache_file(cache_path, z.read(name))
+
+            uuids = json.loads(z.read('uuids.json'))
+            if uuid_list.uuids is None:
+                uuid_list.uuids = tuple(uuids)
+            audio_iris.update(json.loads(z.read('audio.json')))
+
+            if z.read('version').decode('utf-8') == code_version():
+                for name in z.namelist():
+                    if name.startswith('lessons/'):
+                        data = json.loads(z.read(name))
+                        uuid = os.path.basename(name)[:-len('.json')]
+                        lesson_cache.set(uuid, Lesson(uuid, data.pop('hash'), **data))
+    except Exception:
+        app.logger.exception('Unable to restore the snapshot %s.', path)
+
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,172 @@
+"""Benchmark lesson parsing, extraction and page rendering, offline.
+
+   The app runs against bench.fake_ochre, so no OCHRE access is needed.
+   Each benchmark is run --repeat times and its best time is compared
+   with bench/baseline.json; anything more than --tolerance slower (and
+   at least 0.05 ms slower) is reported as a regression, and the exit
+   status is 1.
+
+       python -m bench.benchmark
+       python -m bench.benchmark --save    # store a new baseline
+
+   Baselines are only comparable on the same machine, so regenerate
+   baseline.json with --save after changing hardware.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench.fake_ochre import FakeOchre, lesson_uuids
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# changes smaller than this, in seconds, are noise.
+MIN_CHANGE = 0.00005
+
+
+def load_app(server, cache_dir):
+    """Import the app, configured to use the stand-in OCHRE server."""
+    os.environ.setdefault(
+        'LUCY_SETTINGS',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.py')
+    )
+    import app as lucy
+    lucy.app.config.update(
+        OCHRE_CACHE_DIR=cache_dir,
+        OCHRE_SERVER=server.url,
+        PROJECT_URL=server.url + '/project'
+    )
+    lucy.get_uuids(wait=True)
+    return lucy
+
+
+def time_it(fn, repeat):
+    """Get the best time of fn() in seconds, after one warm-up call. As
+       with timeit, the garbage collector is off while timing.
+    """
+    fn()
+    timings = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return min(timings)
+
+
+def run(lucy, repeat):
+    """Run every benchmark. Returns a dict of benchmark name -> best
+       time in seconds.
+    """
+    client = lucy.app.test_client()
+    results = {}
+
+    for uuid in lesson_uuids():
+        xml = lucy.fetch_xml(lucy.ochre_url(uuid))
+
+        def parse():
+            parser = lucy.LessonParser()
+            for i in range(0, len(xml), lucy.CHUNK_SIZE):
+                parser.feed(xml[i:i + lucy.CHUNK_SIZE])
+            return parser.close()
+
+        tree = parse()
+        name = 'lesson{}'.format(
+            tree.find('.//ochre/text/identification/abbreviation').text
+        )
+        results['parse/' + name] = time_it(parse, repeat)
+        results['index/' + name] = time_it(lambda: lucy.SectionIndex(tree), repeat)
+
+        index = lucy.SectionIndex(tree)
+        for extractor in lucy.EXTRACTORS[1:]:
+            results['extract/{}/{}'.format(extractor.__name__, name)] = time_it(
+                lambda: extractor(tree, index).as_list(),
+                repeat
+            )
+
+        def cold():
+            # drop the lesson from the shared cache too, or it's only
+            # extracted the first time.
+            lucy.lesson_cache.items.clear()
+            lucy.shared_cache.connect().execute(
+                'DELETE FROM lessons WHERE uuid = ?', (uuid,)
+            )
+            client.get('/?uuid={}&section=0'.format(uuid))
+
+        results['cold/' + name] = time_it(cold, repeat)
+
+        for section in range(len(lucy.EXTRACTORS)):
+            url = '/?uuid={}&section={}'.format(uuid, section)
+            results['render/{}/{}'.format(section, name)] = time_it(
+                lambda: client.get(url),
+                repeat
+            )
+
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print a table of results. Returns the names of the benchmarks
+       that regressed.
+    """
+    regressions = []
+    print('{:<45} {:>10} {:>10} {:>8}'.format('benchmark', 'ms', 'baseline', 'change'))
+    for name, seconds in sorted(results.items()):
+        line = '{:<45} {:>10.3f}'.format(name, seconds * 1000)
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += ' {:>10.3f} {:>+7.0%}'.format(baseline[name] * 1000, change)
+            if change > tolerance and seconds - baseline[name] > MIN_CHANGE:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction slower than the baseline that counts as a regression')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    server = FakeOchre().start()
+    # prefetching would only add background noise to the timings, and
+    # the audio threads may still be writing to the cache at the end.
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as cache_dir:
+        lucy = load_app(server, cache_dir)
+        lucy.app.config['PREFETCH'] = False
+        results = run(lucy, args.repeat)
+    server.shutdown()
+
+    try:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {}
+
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved the baseline to {}.'.format(BASELINE))
+    elif regressions:
+        print('{} benchmarks regressed.'.format(len(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
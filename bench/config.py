@@ -0,0 +1,7 @@
+# Settings for running the app against bench.fake_ochre, used by the
+# benchmarks in place of config/local.py. The benchmarks point
+# OCHRE_SERVER and PROJECT_URL at the stand-in server once it is
+# running, and keep their on-disk cache in a temporary directory.
+
+OCHRE_SERVER = 'http://127.0.0.1:8765'
+PROJECT_URL = OCHRE_SERVER + '/project'
@@ -0,0 +1,110 @@
+"""A stand-in for the OCHRE API, serving the XML in bench/fixtures.
+
+   Lessons and grammar documents are served from fixtures/<uuid>.xml and
+   the project document from fixtures/project.xml. Any other UUID is
+   treated as an audio resource, whose IRI points back at this server.
+   Every response can be delayed to simulate a slow upstream server:
+
+       python -m bench.fake_ochre --port 8765 --latency 0.2
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+AUDIO_RESOURCE = '''<?xml version="1.0" encoding="UTF-8"?>
+<result><ochre><resource uuid="{uuid}" type="audio"><identification><label>{uuid}</label></identification><link iri="{url}/audio/{uuid}.mp3"/></resource></ochre></result>
+'''
+
+
+class FakeOchreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/audio/'):
+            body = b'ID3' + url.path.encode('utf-8')
+            content_type = 'audio/mpeg'
+        elif url.path == '/ochre':
+            uuid = urllib.parse.parse_qs(url.query).get('uuid', [''])[0]
+            body = self.server.document(uuid)
+            content_type = 'text/xml'
+        else:
+            body = self.server.document('project')
+            content_type = 'text/xml'
+
+        time.sleep(self.server.latency)
+        self.server.count()
+
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOchre(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, fixtures=FIXTURES):
+        super().__init__(address, FakeOchreHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def document(self, uuid):
+        path = os.path.join(self.fixtures, os.path.basename(uuid) + '.xml')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return AUDIO_RESOURCE.format(uuid=uuid, url=self.url).encode('utf-8')
+
+    def start(self):
+        """Serve requests from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def lesson_uuids(fixtures=FIXTURES):
+    """Get the UUIDs of the lessons in the fixtures, in course order."""
+    import xml.etree.ElementTree as ET
+    tree = ET.parse(os.path.join(fixtures, 'project.xml'))
+    return [el.get('uuid') for el in tree.findall('.//text[@uuid]')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    args = parser.parse_args()
+    server = FakeOchre(('127.0.0.1', args.port), args.latency)
+    print('Serving {} at {}'.format(FIXTURES, server.url))
+    server.serve_forever()
@@ -0,0 +1,230 @@
+"""Load test the app with simulated classroom traffic.
+
+   By default the app is served the way wsgi.conf runs it under
+   mod_wsgi, by one process with a fixed pool of --threads worker
+   threads, in front of a bench.fake_ochre server with --latency seconds
+   of upstream latency. Pass --url to load test a running deployment
+   instead. Its lessons are taken from the project document at
+   --project-url, or can be listed with --uuids.
+
+   Each of --users simulated students starts at a random lesson and
+   works through sections 1 to 9 in order, then moves on to the next
+   lesson, pausing for --think seconds on average between pages.
+
+       python -m bench.loadtest --users 40 --duration 60
+
+   The report gives throughput, latency percentiles per section and,
+   for the local server, how busy the worker threads were and how long
+   requests waited for one.
+"""
+
+import argparse
+import http.client
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from bench.benchmark import load_app
+from bench.fake_ochre import FakeOchre, lesson_uuids
+
+# the project document the app reads its lesson list from, PROJECT_URL
+# in app.py.
+PROJECT_URL = 'http://pi.lib.uchicago.edu/1001/org/ochre/bccb5942-7768-4c0d-aa20-b78bcc970bac'
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server that handles requests with a fixed pool of worker
+       threads, like mod_wsgi's daemon mode, and keeps track of how busy
+       they are.
+    """
+    threads = 15
+
+    def server_activate(self):
+        super().server_activate()
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.lock = threading.Lock()
+        self.max_busy = 0
+        self.waits = []
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.work, request, client_address, time.perf_counter())
+
+    def work(self, request, client_address, queued):
+        start = time.perf_counter()
+        with self.lock:
+            self.busy += 1
+            self.max_busy = max(self.max_busy, self.busy)
+            self.waits.append(start - queued)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.busy -= 1
+                self.busy_seconds += time.perf_counter() - start
+
+
+def project_uuids(url):
+    """Get the lesson UUIDs from a project document, in course order."""
+    with urllib.request.urlopen(url, timeout=60) as response:
+        tree = ET.fromstring(response.read())
+    return [el.get('uuid') for el in tree.findall('.//text[@uuid]')]
+
+
+def student(url, uuids, think, deadline, results, lock):
+    """Work through the course until the deadline, recording
+       (section, seconds, status) for every page.
+    """
+    parts = urllib.parse.urlsplit(url)
+    lesson = random.randrange(len(uuids))
+    section = 1
+    while time.time() < deadline:
+        path = '{}/?uuid={}&section={}'.format(parts.path.rstrip('/'), uuids[lesson], section)
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            conn.close()
+        except OSError:
+            status = None
+        with lock:
+            results.append((section, time.perf_counter() - start, status))
+
+        section += 1
+        if section == 10:
+            section = 1
+            lesson = (lesson + 1) % len(uuids)
+        time.sleep(random.expovariate(1 / think) if think else 0)
+
+
+def percentile(cuts, p):
+    return cuts[p - 1] * 1000
+
+
+def report(results, elapsed, server=None):
+    print('{} requests in {:.1f}s: {:.1f} requests/s, {} errors'.format(
+        len(results),
+        elapsed,
+        len(results) / elapsed,
+        sum(1 for _, _, status in results if status != 200)
+    ))
+    print('{:<8} {:>8} {:>9} {:>9} {:>9}'.format('section', 'requests', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for section in range(1, 10):
+        timings = [t for s, t, _ in results if s == section]
+        if len(timings) < 2:
+            continue
+        cuts = statistics.quantiles(timings, n=100)
+        print('{:<8} {:>8} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            section,
+            len(timings),
+            percentile(cuts, 50),
+            percentile(cuts, 95),
+            percentile(cuts, 99)
+        ))
+    if server is not None:
+        print('worker threads: {:.0%} busy on average, {} of {} busy at most'.format(
+            server.busy_seconds / (server.threads * elapsed),
+            server.max_busy,
+            server.threads
+        ))
+        if len(server.waits) >= 2:
+            cuts = statistics.quantiles(server.waits, n=100)
+            print('waiting for a worker thread: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+                percentile(cuts, 50),
+                percentile(cuts, 95),
+                percentile(cuts, 99)
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='load test a running deployment at this URL')
+    parser.add_argument('--project-url', default=PROJECT_URL,
+                        help='project document to get the lessons from, with --url')
+    parser.add_argument('--uuids', help='comma separated lessons to visit, with --url')
+    parser.add_argument('--users', type=int, default=30,
+                        help='number of simulated students')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='mean seconds between a student\'s pages')
+    parser.add_argument('--threads', type=int, default=15,
+                        help='worker threads for the local server (threads= in wsgi.conf)')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='seconds of latency for the stand-in OCHRE server')
+    args = parser.parse_args()
+
+    server = None
+    # the app's prefetch and audio threads may still be writing to the
+    # cache when the load test ends.
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as cache_dir:
+        if args.url:
+            url = args.url
+            if args.uuids:
+                uuids = args.uuids.split(',')
+            else:
+                uuids = project_uuids(args.project_url)
+            if not uuids:
+                sys.exit('No lessons to visit.')
+        else:
+            uuids = lesson_uuids()
+            ochre = FakeOchre(latency=args.latency).start()
+            lucy = load_app(ochre, cache_dir)
+            PooledWSGIServer.threads = args.threads
+            server = make_server(
+                '127.0.0.1', 0, lucy.app,
+                server_class=PooledWSGIServer,
+                handler_class=QuietHandler
+            )
+            server.request_queue_size = 128
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        results = []
+        lock = threading.Lock()
+        start = time.time()
+        deadline = start + args.duration
+        students = [
+            threading.Thread(
+                target=student,
+                args=(url, uuids, args.think, deadline, results, lock)
+            )
+            for _ in range(args.users)
+        ]
+        for s in students:
+            s.start()
+        for s in students:
+            s.join()
+        elapsed = time.time() - start
+
+        if server is not None:
+            server.shutdown()
+            ochre.shutdown()
+
+        if not results:
+            sys.exit('No requests were made.')
+        report(results, elapsed, server)
+
+
+if __name__ == '__main__':
+    main()
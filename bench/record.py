@@ -0,0 +1,55 @@
+"""Record lessons from a live OCHRE server as benchmark fixtures.
+
+       python -m bench.record https://ochre.lib.uchicago.edu UUID [UUID ...]
+
+   Each lesson is saved to bench/fixtures along with its grammar block
+   documents, and fixtures/project.xml is rewritten to list the lessons
+   in the order given. Audio resources aren't recorded: bench.fake_ochre
+   makes them up.
+"""
+
+import argparse
+import os
+import urllib.request
+import xml.etree.ElementTree as ET
+
+from bench.fake_ochre import FIXTURES
+
+GRAMMAR = 'fc6b91e0-00f8-4a32-8aed-4934432253de'
+
+
+def record(server, uuid):
+    """Save the document for a UUID. Returns its contents."""
+    with urllib.request.urlopen('{}/ochre?uuid={}'.format(server, uuid)) as response:
+        xml = response.read()
+    with open(os.path.join(FIXTURES, uuid + '.xml'), 'wb') as f:
+        f.write(xml)
+    return xml
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('server', help='e.g. https://ochre.lib.uchicago.edu')
+    parser.add_argument('uuids', nargs='+', help='lesson UUIDs')
+    args = parser.parse_args()
+
+    for uuid in args.uuids:
+        tree = ET.fromstring(record(args.server, uuid))
+        for section in tree.findall('.//discourseHierarchy/section'):
+            if section.findall('.//property/value[@uuid="{}"]'.format(GRAMMAR)):
+                record(args.server, section.find('./links/resource').get('uuid'))
+        print('Recorded {}.'.format(uuid))
+
+    project = ET.Element('result')
+    ochre = ET.SubElement(project, 'ochre')
+    for uuid in args.uuids:
+        ET.SubElement(ochre, 'text', uuid=uuid)
+    ET.ElementTree(project).write(
+        os.path.join(FIXTURES, 'project.xml'),
+        encoding='UTF-8',
+        xml_declaration=True
+    )
+
+
+if __name__ == '__main__':
+    main()
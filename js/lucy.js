@@ -32,8 +32,10 @@ $(document).ready(function() {
   });
 
 
-  // Playable sound clips, e.g. in basic sentences sections.
-  $('.playable').each(function() {
+  // Playable sound clips, e.g. in basic sentences sections. The server
+  // links directly to audio files it could resolve; anything still
+  // pointing at an OCHRE resource is looked up here.
+  $('.playable[href*="ochre?uuid="]').each(function() {
     var el = $(this);
     var url = $(this).attr('href').replace('http://', 'https://');
     $.ajax({